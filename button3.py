@@ -1,44 +1,68 @@
-from machine import Pin, Signal, PWM
+from machine import Pin, Signal, PWM, disable_irq, enable_irq
 import time
-
-
-class KeyList():
-    ''' (key, value) のリストを制御する '''
-    def __init__(self):
-        self._klist: list[tuple[object, object]] = []
-
-    def _findkey(self, key) -> int:
-        ''' keyに合致するデータのインデックスを返す。存在しなければ -1 を返す '''
-        for i in range(len(self._klist)):
-            if self._klist[i][0] == key:
-                return i
-        return -1
-
-    def __setitem__(self, key, value):
-        i = self._findkey(key)
-        if i != -1:
-            self._klist[i] = (key, value)
+import array
+import gc
+import micropython
+from micropython import const
+
+# 割り込みハンドラー内で発生した例外のトレースバック用バッファ
+micropython.alloc_emergency_exception_buf(100)
+
+
+# 割り込みハンドラーからのログ（リングバッファ）
+# ハンドラー内ではヒープを確保できないので、イベントコード(int)だけを記録し、
+# 表示はメインループから print_log() で行う
+# 書き込むのは割り込みハンドラーだけ（他から書くと、書き込みが競合する）
+# イベントコード: ボタン番号(bit16-29)、IRQフラグ(bit8-15)、イベント種別(bit0-7)
+# （small int の範囲(30bit)に収めるため、ボタン番号は _LOG_NO_MAX まで）
+_LOG_REJECTED = const(1)    # ゴースト除去で押下を無視した
+_LOG_PUSHED = const(2)      # ボタンが押された
+_LOG_NO_MAX = const(0x3fff)     # ボタン番号の最大値
+_log_buf = array.array('i', [0] * 32)
+_log_head = 0           # 次に書き込む位置（割り込みハンドラーが更新）
+_log_tail = 0           # 次に読み出す位置（メインループが更新）
+_log_dropped = 0        # バッファが一杯で記録できなかったログの数
+_log_names: list[str] = []     # ボタン番号に対応するボタンの名前
+
+
+def _put_log(no: int, flag: int, event: int):
+    ''' ログにイベントコードを記録する（割り込みハンドラーから呼ぶ） '''
+    global _log_head, _log_dropped
+    nxt = (_log_head + 1) % len(_log_buf)
+    if nxt == _log_tail:    # バッファが一杯（未表示のログは上書きしない）
+        _log_dropped += 1
+        return
+    _log_buf[_log_head] = (no << 16) | ((flag & 0xff) << 8) | event
+    _log_head = nxt
+
+
+def print_log():
+    ''' 記録されたログを表示する（メインループから呼ぶ） '''
+    global _log_tail, _log_dropped
+    while _log_tail != _log_head:
+        code = _log_buf[_log_tail]
+        _log_tail = (_log_tail + 1) % len(_log_buf)
+        name = _log_names[code >> 16]
+        flag = (code >> 8) & 0xff
+        if code & 0xff == _LOG_PUSHED:
+            print(f"@@@@_PUSHED!! ({flag:02x}) {name}")
         else:
-            self._klist.append((key, value))
-
-    def __getitem__(self, key):
-        i = self._findkey(key)
-        if i != -1:
-            return self._klist[i][1]
-        return None
+            print(f"push rejected!! for {name}")
 
-    def keys(self):
-        return [item[0] for item in self._klist]
-
-    def values(self):
-        return [item[1] for item in self._klist]
+    if _log_dropped:
+        # 割り込みハンドラーと同時に更新しないよう、割り込みを止めて読み出す
+        state = disable_irq()
+        dropped = _log_dropped
+        _log_dropped = 0
+        enable_irq(state)
+        print(f"log dropped!! ({dropped})")
 
 
 class Button():
     ''' 押しボタンクラス '''
 
-    # (指定されたPin, 生成されたボタンinstance) のリスト
-    _kroster = KeyList()
+    # 指定されたPin の id() をキーとした、生成されたボタンinstance の辞書
+    _kroster: dict = {}
 
     def __init__(self, _pin,                # 登録した Pin
                  name: str | None = None,   # 登録する Pinの名前（任意）
@@ -51,97 +75,133 @@ class Button():
         print(_pin)
         self._pin = _pin                # 登録した Pin
         self._invert = invert           # ボタンがGND接続のとき、Trueを指定
-        self._signal = Signal(_pin, invert=self._invert)
+        # pinの状態（signal）を読む関数。invertならpinの値を反転して返す
+        self._read = (lambda p=_pin: 1 ^ p.value()) if invert else _pin.value
 
         # ボタンの名前を取得（引数で省略なら"GPIOxx"を設定）
         self._name = name if name else Button._get_name(self._pin)
 
+        # ログ表示用のボタン番号を取得
+        # 同じPinでボタンを作り直した場合は、古いボタンの番号を引き継ぐ
+        old = Button._get_myself(self._pin)
+        if old:
+            self._log_no = old._log_no
+            _log_names[self._log_no] = self._name
+        else:
+            if len(_log_names) > _LOG_NO_MAX:
+                raise RuntimeError("too many buttons!")
+            self._log_no = len(_log_names)
+            _log_names.append(self._name)
+
         self._time_ticks = 0            # チャタリング防止用 time_ticks
         self._dtime = bouncetime        # チャタリング防止時間(ms)
+        self._ticks_ms = time.ticks_ms      # 割り込み時用に事前に取得
+        self._ticks_diff = time.ticks_diff  # 割り込み時用に事前に取得
 
         self._count = 0                 # 押された回数
         self._function = function       # ボタンが押された時のファンクション
         self._fargs = args              # ファンクションの位置引数
         self._fkwargs = kwargs          # ファンクションのキーワード引数
+        self._invoke = self._make_invoke()  # ファンクションの呼び出し用
 
         # 生成されたinstanceと指定されたPinを内部のリストに登録
         self._put_myself(self._pin)
 
         # 割り込みハンドラーを設定（ボタンが押された時）
+        # ハンドラー内ではヒープを確保しないので、hard IRQとして登録する
         if self._invert:
-            self._pin.irq(trigger=Pin.IRQ_FALLING, handler=Button._handler)
+            self._pin.irq(trigger=Pin.IRQ_FALLING, handler=Button._handler,
+                          hard=True)
         else:
-            self._pin.irq(trigger=Pin.IRQ_RISING, handler=Button._handler)
+            self._pin.irq(trigger=Pin.IRQ_RISING, handler=Button._handler,
+                          hard=True)
 
     @staticmethod
+    @micropython.native
     def _handler(pin):
-        ''' ボタンが押された時の割り込みハンドラー '''
-        _flag = pin.irq().flags()
-        print(f"  (0x{_flag:02x})")
-
+        ''' ボタンが押された時の割り込みハンドラー
+            hard IRQで呼ばれるので、ここではヒープを確保してはいけない '''
         myself = Button._get_myself(pin)    # 割り込み対象の自object（myself）を取得
         if not myself:      # 自分的に存在しないボタンの場合は無視
             return
         # チャタリング防止のため制限時間内の再割り込みは無視
-        if time.ticks_diff(time.ticks_ms(), myself._time_ticks) < myself._dtime:
+        now = myself._ticks_ms()
+        if myself._ticks_diff(now, myself._time_ticks) < myself._dtime:
             return
         # ゴースト除去。多分ボタンリリース時のチャタリング
-        if not myself._signal.value():
-            print(f"push rejected!! for {myself._name}")
+        if not myself._read():
+            _put_log(myself._log_no, pin.irq().flags(), _LOG_REJECTED)
             return
 
         ''' これ以降が、ボタンが押された場合の処理 '''
-        print(f"@@@@_PUSHED!! ({_flag:02x}) {myself.get_name()}")
+        _put_log(myself._log_no, pin.irq().flags(), _LOG_PUSHED)
         myself._count += 1
 
-        # 登録されたファンクションを実行
-        if myself._function:
-            myself._do_function(myself._function, myself._fargs, myself._fkwargs)
+        # 登録されたファンクションの実行を予約（hard IRQの外で実行される）
+        if myself._invoke:
+            try:
+                micropython.schedule(myself._invoke, 0)
+            except RuntimeError:    # 予約キューが一杯の場合は、今回は実行しない
+                pass
 
-        myself._time_ticks = time.ticks_ms()
+        myself._time_ticks = myself._ticks_ms()
 
     @staticmethod
     def _get_name(pin: Pin) -> str:
         ''' Pinに設定されている名前（GPIOxx）を取得する '''
-        return repr(pin).split("(")[1].split(",")[0]
+        # repr(pin) は "Pin(GPIOxx, mode=..., ...)" または "Pin(GPIOxx)" の形式
+        r = repr(pin)
+        end = r.find(",")
+        if end == -1:
+            end = r.find(")")
+        return r[r.find("(") + 1:end if end != -1 else len(r)]
 
     @classmethod
     def _get_myself(cls, _pin):
         ''' 内部リストから、_pinに該当するボタンのinstance(myself)を取得する '''
-        return cls._kroster[_pin]
+        return cls._kroster.get(id(_pin))
 
     def _put_myself(self, _pin):
         ''' 内部リストに、生成されたinstance(self)と指定されたPinを登録する '''
-        # _pin重複チェック。重複していたら古いinstanceは削除
-        btn = Button._kroster[_pin]
-        if btn:
-            del btn
-        Button._kroster[_pin] = self
+        # _pin重複時は古いinstanceを上書き（古いinstanceは登録解除される）
+        Button._kroster[id(_pin)] = self
 
     def _exist_myself(self) -> bool:
         ''' ボタンinstanceが生きているかのチェック '''
-        return self in self._kroster.values()
-
-    def _do_function(self, function, fargs, fkwargs):
-        ''' ボタンに対して、登録された function を実行する '''
+        return Button._kroster.get(id(self._pin)) is self
+
+    def _make_invoke(self):
+        ''' ボタンに対して、登録された function を実行する関数を生成する
+            （micropython.schedule() から呼ばれるので、引数を1つ受け取る） '''
+        function = self._function
+        fargs = self._fargs
+        fkwargs = self._fkwargs
+        if not function:                # ファンクションなし
+            return None
+        # 対向のボタン(opposite)は、その状態を読む関数に置き換えておく
+        # （押される毎に、ボタンのメソッドを呼ばなくて済むように）
+        if fkwargs and isinstance(fkwargs.get('opposite'), Button):
+            fkwargs = dict(fkwargs, opposite=fkwargs['opposite']._read)
         if fargs is not None:           # 位置引数あり
             if not isinstance(fargs, tuple):    # tupleでなければ tuple化
                 fargs = (fargs, )
             if fkwargs:                      # 位置引数とキーワード引数あり
-                function(*fargs, **fkwargs, myself=self)
+                return lambda _arg: function(*fargs, **fkwargs, myself=self)
             else:                           # 位置引数のみ
-                function(*fargs, myself=self)
+                return lambda _arg: function(*fargs, myself=self)
         elif fkwargs:                    # キーワード引数あり
-            function(**fkwargs, myself=self)
+            return lambda _arg: function(**fkwargs, myself=self)
         else:                           # 引数なし
-            function(myself=self)
+            return lambda _arg: function(myself=self)
 
     def set_function(self, function=None, args=None, kwargs=None):
         ''' ボタンが押された時の動作を登録する '''
-        assert self._exist_myself(), f"{self} is expired!"
+        if not self._exist_myself():    # 同じPinで新しいボタンが生成されていた
+            raise RuntimeError("button is expired!")
         self._function = function
         self._fargs = args
         self._fkwargs = kwargs
+        self._invoke = self._make_invoke()
 
     def get_count(self) -> int:
         ''' ボタンが押された回数を返す '''
@@ -157,7 +217,11 @@ class Button():
 
     def get_signal(self):
         ''' ボタンに設定したpinの状態（signal）を返す '''
-        return self._signal()
+        return self._read()
+
+
+# Volume のカーブ名と指数の対応
+_CURVE_MAP = {'A': 2, 'B': 1, 'C': 0.7, 'D': 3}
 
 
 class Volume():
@@ -180,33 +244,57 @@ class Volume():
         if type(curve) is int or type(curve) is float:
             self._exp: int | float = curve
         else:
-            assert curve in list('ABCD'),\
+            assert curve in _CURVE_MAP,\
                 "The value of the argument 'curve' must be one of the following:"\
                 " 'A','B','C','D' or numeric"
-            self._exp = {'A': 2, 'B': 1, 'C': 0.7, 'D': 3}.get(curve)
+            self._exp = _CURVE_MAP[curve]
+
+        # ボリューム値(min～max)に対応する PWMの duty値(u16)を事前に計算しておく
+        self._table = array.array('H')
+        for value in range(min, max + 1):
+            reg = value ** self._exp / self._range ** self._exp
+            reg = (1 - reg) if self._invert else reg
+            # min > 0 だと reg が 1を超えるので、duty値の範囲(0～65535)に収める
+            u16 = int(65535 * reg)
+            self._table.append(0 if u16 < 0 else 65535 if u16 > 65535 else u16)
 
         pwm.freq(freq)
-        pwm.duty_u16(self.u16value(min))
+        self._last_u16 = -1     # 最後に PWMに設定した duty値(u16)
+        self._set_duty(self._table[0])
 
     def u16value(self, value) -> int:
-        reg = value ** self._exp / self._range ** self._exp
-        reg = (1 - reg) if self._invert else reg
-        return int(65535 * reg)
+        ''' ボリューム値に対応する PWMの duty値(u16)を返す '''
+        if not self._min <= value <= self._max:
+            raise ValueError("volume value out of range")
+        return self._table[value - self._min]
+
+    def _set_duty(self, u16: int):
+        ''' PWMに duty値を設定する（前回と同じ値なら何もしない） '''
+        # duty値の変更は周期の途中でも反映されるので、無駄な書き込みはしない
+        if u16 != self._last_u16:
+            self._pwm.duty_u16(u16)
+            self._last_u16 = u16
 
     def up(self, opposite=None, myself=None) -> int:
-        ''' ボリュームを一段上げる '''
-        self._vol = min(self._vol + 1, self._max)
-        if opposite.get_signal():   # 対向のボタンも（同時に）押されてた
+        ''' ボリュームを一段上げる
+            opposite は対向のボタンの状態を読む関数
+            （Button.set_function() で対向のボタンを渡すと、この関数に置き換えられる） '''
+        vol = self._vol + 1
+        self._vol = vol if vol <= self._max else self._max
+        # 対向のボタンも（同時に）押されてた
+        if opposite is not None and opposite():
             self._vol = self._min
-        self._pwm.duty_u16(self.u16value(self._vol))
+        self._set_duty(self._table[self._vol - self._min])
         return self._vol
 
     def down(self, myself=None, opposite=None) -> int:
-        ''' ボリュームを一段下げる '''
-        self._vol = max(self._vol - 1, self._min)
-        if opposite.get_signal():   # 対向のボタンも（同時に）押されてた
+        ''' ボリュームを一段下げる（opposite は up() と同じ） '''
+        vol = self._vol - 1
+        self._vol = vol if vol >= self._min else self._min
+        # 対向のボタンも（同時に）押されてた
+        if opposite is not None and opposite():
             self._vol = self._min
-        self._pwm.duty_u16(self.u16value(self._vol))
+        self._set_duty(self._table[self._vol - self._min])
         return self._vol
 
     def get_value(self) -> int:
@@ -250,45 +338,74 @@ class Toggle():
 # GPIOにアノード側を接続するときは、出力Hで点灯
 # GPIOにカソード側を接続するときは、出力Lで点灯（invert）
 
+_BOUNCE = const(200)        # 押しボタンのチャタリング防止時間(ms)
+_LOOP_MS = const(10)        # メインループの周期(ms)
+_GC_LOOPS = const(100)      # gc.collect() を行うメインループの回数
+
+# 押しボタン、LEDを接続する GPIO番号
+_GPIO_BTN_R = const(11)
+_GPIO_BTN_G_OFF = const(12)
+_GPIO_BTN_G_ON = const(13)
+_GPIO_BTN_Y_DOWN = const(14)
+_GPIO_BTN_Y_UP = const(15)
+_GPIO_LED_Y = const(16)
+_GPIO_LED_G = const(17)
+_GPIO_LED_R = const(18)
+
+
+def _mkbtn(pin, fn=None, invert=False, name=None) -> Button:
+    ''' 共通のチャタリング防止時間で、押しボタンを生成する '''
+    return Button(pin, name=name, function=fn, invert=invert,
+                  bouncetime=_BOUNCE)
+
+
 # [物理]設定
-pin11 = Pin(11, Pin.IN, Pin.PULL_UP)            # 赤LED用押しボタン
-ledR = Signal(Pin(18, Pin.OUT, value=0))        # 赤LED
+pin11 = Pin(_GPIO_BTN_R, Pin.IN, Pin.PULL_UP)       # 赤LED用押しボタン
+ledR = Signal(Pin(_GPIO_LED_R, Pin.OUT, value=0))   # 赤LED
 
 # [論理]設定
 ledR_toggle = Toggle(ledR)                      # 赤LED用トグルスイッチを定義
 # 赤LED用押しボタンに、トグルスイッチを接続
-btn0 = Button(pin11, function=ledR_toggle.toggle, invert=True, bouncetime=200)
+btn0 = _mkbtn(pin11, ledR_toggle.toggle, invert=True)
 
 
 # [物理]設定
-pin12 = Pin(12, Pin.IN, Pin.PULL_DOWN)          # 緑LED用押しボタン（切り）
-pin13 = Pin(13, Pin.IN, Pin.PULL_DOWN)          # 緑LED用押しボタン（入り）
-ledG = Pin(17, Pin.OUT, value=0)                # 緑LED
+pin12 = Pin(_GPIO_BTN_G_OFF, Pin.IN, Pin.PULL_DOWN)  # 緑LED用押しボタン（切り）
+pin13 = Pin(_GPIO_BTN_G_ON, Pin.IN, Pin.PULL_DOWN)   # 緑LED用押しボタン（入り）
+ledG = Pin(_GPIO_LED_G, Pin.OUT, value=0)           # 緑LED
 
 # [論理]設定
 ledG_switch = OnOff_Switch(ledG)                # 緑LED用入り切りスイッチを定義
 # 緑LED用押しボタンに、「切り」スイッチ、「入り」スイッチを接続
-btnG_off = Button(pin12, name="G_off", function=ledG_switch.off, bouncetime=200)
-btnG_on = Button(pin13, name="G_on", function=ledG_switch.on, bouncetime=200)
+btnG_off = _mkbtn(pin12, ledG_switch.off, name="G_off")
+btnG_on = _mkbtn(pin13, ledG_switch.on, name="G_on")
 
 
 # [物理]設定
-pin14 = Pin(14, Pin.IN, Pin.PULL_UP)            # 黄LED用押しボタン（down）
-pin15 = Pin(15, Pin.IN, Pin.PULL_UP)            # 黄LED用押しボタン（up）
-ledY = Pin(16, Pin.OUT, value=1)                # 黄LED
+pin14 = Pin(_GPIO_BTN_Y_DOWN, Pin.IN, Pin.PULL_UP)   # 黄LED用押しボタン（down）
+pin15 = Pin(_GPIO_BTN_Y_UP, Pin.IN, Pin.PULL_UP)     # 黄LED用押しボタン（up）
+ledY = Pin(_GPIO_LED_Y, Pin.OUT, value=1)           # 黄LED
 
 # [論理]設定
 # 黄LED用照度up/downボタンを定義
 ledY_vol = Volume(PWM(ledY), min=0, max=10, curve='A')
 # 黄LED用押しボタンdown、upを接続
-btnY_down = Button(pin14, name="Y_down", invert=True, bouncetime=200)
-btnY_up = Button(pin15, name="Y_up", invert=True, bouncetime=200)
+btnY_down = _mkbtn(pin14, invert=True, name="Y_down")
+btnY_up = _mkbtn(pin15, invert=True, name="Y_up")
 # 黄LED用押しボタンdown、upにボリュームdown、ボリュームup機能を設定
 btnY_down.set_function(ledY_vol.down, kwargs={'opposite': btnY_up})
 btnY_up.set_function(ledY_vol.up, (), {'opposite': btnY_down})
 
+loop_count = 0
 while True:
     '''
     ここにいろいろ、メイン処理を書く
     '''
-    pass
+    print_log()
+
+    # GCは割り込み処理中でなく、メインループの決まったタイミングで行う
+    loop_count += 1
+    if loop_count >= _GC_LOOPS:
+        gc.collect()
+        loop_count = 0
+    time.sleep_ms(_LOOP_MS)